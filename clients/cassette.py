@@ -0,0 +1,160 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, Optional
+
+import httpx
+
+
+# Headers that describe the wire encoding of the recorded body. The body is
+# stored decoded, so replaying them would make httpx decode it a second time.
+WIRE_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+
+class CassetteMissError(Exception):
+    pass
+
+
+def request_key(method: str, url: str, body: bytes) -> str:
+    digest = hashlib.sha256()
+    digest.update(method.encode("utf-8") + b" " + url.encode("utf-8") + b"\n")
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def encode_body(body: bytes) -> Dict[str, str]:
+    try:
+        return {"body": body.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"body": base64.b64encode(body).decode("ascii"), "encoding": "base64"}
+
+
+def decode_body(entry: dict) -> bytes:
+    if entry.get("encoding") == "base64":
+        return base64.b64decode(entry["body"])
+    return entry["body"].encode("utf-8")
+
+
+class CassetteTransport(httpx.AsyncBaseTransport):
+    """Records or replays HTTP exchanges at the httpx transport level.
+
+    The cassette holds one interaction per line as "<key>\\t<json>", where the
+    key hashes the method, URL and request body. Replay indexes the key
+    prefixes once and reads each response from its file offset on demand.
+    Identical requests are replayed in the order they were recorded; once
+    exhausted, the last recording is served again.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        mode: str,
+        timing: str = "fast",
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        if timing not in ("fast", "recorded"):
+            raise ValueError(f"Unknown cassette replay timing: {timing}")
+
+        self.path = path
+        self.mode = mode
+        self.timing = timing
+        self.file = None
+        self.transport = None
+        self.index: Dict[str, Deque[int]] = defaultdict(deque)
+        self.last_offsets: Dict[str, int] = {}
+
+        if mode == "record":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.transport = transport or httpx.AsyncHTTPTransport()
+            self.file = open(path, "ab")
+        else:
+            self.file = open(path, "rb")
+            self._build_index()
+
+    def _build_index(self):
+        offset = 0
+        for line in self.file:
+            key, _, _ = line.partition(b"\t")
+            self.index[key.decode("ascii")].append(offset)
+            offset += len(line)
+
+    def _read_entry(self, offset: int) -> dict:
+        self.file.seek(offset)
+        _, _, payload = self.file.readline().partition(b"\t")
+        return json.loads(payload)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        key = request_key(request.method, str(request.url), body)
+        if self.mode == "record":
+            return await self._record(request, key)
+        return await self._replay(request, key)
+
+    async def _record(self, request: httpx.Request, key: str) -> httpx.Response:
+        start_time = time.perf_counter()
+        response = await self.transport.handle_async_request(request)
+        try:
+            content = await response.aread()
+        finally:
+            await response.aclose()
+        elapsed = time.perf_counter() - start_time
+
+        headers = [
+            [name, value]
+            for name, value in response.headers.multi_items()
+            if name.lower() not in WIRE_HEADERS
+        ]
+        entry = {
+            "method": request.method,
+            "url": str(request.url),
+            "status": response.status_code,
+            "headers": headers,
+            "elapsed": round(elapsed, 6),
+            **encode_body(content),
+        }
+        line = key + "\t" + json.dumps(entry, separators=(",", ":")) + "\n"
+        self.file.write(line.encode("utf-8"))
+        self.file.flush()
+
+        return httpx.Response(
+            response.status_code,
+            headers=headers,
+            content=content,
+            request=request,
+        )
+
+    async def _replay(self, request: httpx.Request, key: str) -> httpx.Response:
+        offsets = self.index.get(key)
+        if offsets:
+            offset = offsets.popleft()
+            self.last_offsets[key] = offset
+        elif key in self.last_offsets:
+            offset = self.last_offsets[key]
+        else:
+            raise CassetteMissError(
+                f"No recorded response for {request.method} {request.url} in {self.path}"
+            )
+
+        entry = self._read_entry(offset)
+        if self.timing == "recorded":
+            await asyncio.sleep(entry["elapsed"])
+
+        return httpx.Response(
+            entry["status"],
+            headers=entry["headers"],
+            content=decode_body(entry),
+            request=request,
+        )
+
+    async def aclose(self):
+        if self.transport is not None:
+            await self.transport.aclose()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
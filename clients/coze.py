@@ -45,9 +45,9 @@ class Completion:
 
 
 class AsyncCoze:
-    def __init__(self, api_key: str, timeout=30.0):
+    def __init__(self, api_key: str, timeout=30.0, transport=None):
         self.api_key = api_key
-        self.client = httpx.AsyncClient(timeout=timeout)
+        self.client = httpx.AsyncClient(timeout=timeout, transport=transport)
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json",
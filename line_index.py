@@ -0,0 +1,145 @@
+import array
+import mmap
+import os
+import struct
+from typing import List, Tuple
+
+
+# Header: magic, source size, source mtime (ns), line count. It is followed by
+# line count + 1 native uint64 offsets: the start of every line, then the end
+# of the file.
+INDEX_MAGIC = b"FCLIDX1\0"
+INDEX_HEADER = struct.Struct("=8sQQQ")
+INDEX_SUFFIX = ".idx"
+READ_CHUNK_SIZE = 1 << 20
+
+
+class LineIndex:
+    """O(1) random access to the lines of a text file.
+
+    Line start offsets are computed in one streaming pass and persisted next
+    to the file (<path>.idx). They are rebuilt when the file's size or
+    modification time changes. The index and the file are memory-mapped, so
+    fetching a line reads only that line. Lines are split on "\\n"; a trailing
+    newline does not start an extra line, and a "\\r" before it is dropped.
+    """
+
+    def __init__(self, path: str, index_path: str = None):
+        self.path = path
+        self.index_path = index_path or path + INDEX_SUFFIX
+        stat = os.stat(path)
+        if not self._is_fresh(stat):
+            self._build(stat)
+
+        self._index_file = open(self.index_path, "rb")
+        self._index_map = mmap.mmap(
+            self._index_file.fileno(), 0, access=mmap.ACCESS_READ
+        )
+        _, _, _, self.line_count = INDEX_HEADER.unpack_from(self._index_map)
+        self._index_view = memoryview(self._index_map)
+        self.offsets = self._index_view[INDEX_HEADER.size :].cast("Q")
+
+        self._source_file = open(path, "rb")
+        self._source_map = (
+            mmap.mmap(self._source_file.fileno(), 0, access=mmap.ACCESS_READ)
+            if stat.st_size
+            else b""
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if self._index_view is None:
+            return
+        self.offsets.release()
+        self._index_view.release()
+        self._index_view = None
+        self._index_map.close()
+        self._index_file.close()
+        if isinstance(self._source_map, mmap.mmap):
+            self._source_map.close()
+        self._source_file.close()
+
+    def __len__(self) -> int:
+        return self.line_count
+
+    def _is_fresh(self, stat: os.stat_result) -> bool:
+        try:
+            with open(self.index_path, "rb") as index_file:
+                header = index_file.read(INDEX_HEADER.size)
+        except FileNotFoundError:
+            return False
+        if len(header) != INDEX_HEADER.size:
+            return False
+        magic, size, mtime_ns, _ = INDEX_HEADER.unpack(header)
+        return (
+            magic == INDEX_MAGIC
+            and size == stat.st_size
+            and mtime_ns == stat.st_mtime_ns
+        )
+
+    def _build(self, stat: os.stat_result):
+        tmp_path = self.index_path + ".tmp"
+        line_count = 0
+        position = 0
+        with open(self.path, "rb") as source_file, open(
+            tmp_path, "wb"
+        ) as index_file:
+            index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, 0, 0, 0))
+            index_file.write(array.array("Q", [0]).tobytes())
+            last_offset = 0
+
+            while True:
+                chunk = source_file.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                offsets = array.array("Q")
+                start = chunk.find(b"\n")
+                while start != -1:
+                    offsets.append(position + start + 1)
+                    start = chunk.find(b"\n", start + 1)
+                index_file.write(offsets.tobytes())
+                line_count += len(offsets)
+                if offsets:
+                    last_offset = offsets[-1]
+                position += len(chunk)
+
+            # The last line has no trailing newline, so close it at EOF
+            if last_offset != position:
+                index_file.write(array.array("Q", [position]).tobytes())
+                line_count += 1
+
+            index_file.seek(0)
+            index_file.write(
+                INDEX_HEADER.pack(
+                    INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, line_count
+                )
+            )
+        os.replace(tmp_path, self.index_path)
+
+    def line_span(self, line_number: int) -> Tuple[int, int]:
+        """Returns the (byte offset, byte length) of a 0-based line."""
+        if not 0 <= line_number < self.line_count:
+            raise IndexError(f"Line {line_number} out of range")
+        start = self.offsets[line_number]
+        end = self.offsets[line_number + 1]
+        if end > start and self._source_map[end - 1 : end] == b"\n":
+            end -= 1
+        if end > start and self._source_map[end - 1 : end] == b"\r":
+            end -= 1
+        return start, end - start
+
+    def get_line(self, line_number: int) -> str:
+        offset, length = self.line_span(line_number)
+        return self._source_map[offset : offset + length].decode("utf-8")
+
+    def get_lines(self, start: int, end: int) -> List[str]:
+        """Returns lines [start, end), clipped to the end of the file."""
+        return [
+            self.get_line(line_number)
+            for line_number in range(start, min(end, self.line_count))
+        ]
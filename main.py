@@ -1,6 +1,8 @@
 import os
 import sys
 import json
+import argparse
+import random
 import openai
 import asyncio
 import logging
@@ -8,16 +10,30 @@ import aiofiles
 import csv
 from dotenv import load_dotenv
 import atexit
-from typing import Any, List, Optional
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
 import logging
 import datetime
+import functools
+from collections import Counter, deque
 from tiktoken import get_encoding
 import subprocess
+import shutil
+import time
 import groq
+import httpx
+from clients.cassette import CassetteTransport
 from clients.coze import AsyncCoze
+from line_index import LineIndex
+from result_store import ResultStore
+from server import ClaimCache, FactCheckServer, MicroBatcher
+from streaming_evaluation import StreamingEvaluator
+from profiling import StageProfiler
 
 
 # python3 main.py
+# python3 main.py --serve
+# python3 main.py --profile
+# python3 main.py --profile-memory
 
 
 # Load environment variables from .env file
@@ -58,6 +74,13 @@ COZE_BOTS = [
 # change model here
 MODEL_NAME = COZE_BOTS[0]
 
+# Models to compare in one pass over the input, each with its own client and
+# rate limiters. Leave empty to run MODEL_NAME alone.
+ENSEMBLE_MODELS = []
+# Use the majority vote of ENSEMBLE_MODELS as the "Predicted Label"; otherwise
+# it is the first model's prediction
+ENSEMBLE_VOTE = True
+
 
 # CONFIGS: PROMPT
 TEXT_DELIMITER = "\n"
@@ -69,6 +92,40 @@ MAX_TOKENS = 3000
 BATCH_SIZE_IN_TOKENS = int(MAX_TOKENS * 0.7)
 MAX_LINES_PER_BATCH = 1  # Maximum number of lines allowed in each batch
 
+# CONFIGS: SCHEDULING
+# Bin-pack lines into requests (first-fit decreasing) instead of sending one
+# batch per request. Rows are still written per batch, under the batch numbers
+# of an unpacked run, once all of a batch's lines are predicted.
+PACK_BATCHES = False
+# Order in which batches are sent: "file", "shortest_first", "largest_first"
+# or "random" (always used with STREAMING_EVALUATION)
+DISPATCH_ORDER = "file"
+
+# CONFIGS: STREAMING EVALUATION
+# Update the confusion matrix and macro-F0.5 as each prediction lands, checking
+# the input in randomized order so partial results are an unbiased sample
+STREAMING_EVALUATION = False
+EVALUATION_CATEGORIES = ["SUPPORTS", "REFUTES", "NOT ENOUGH INFO"]
+EVALUATION_SEED = None  # Seed for the sampling order and the bootstrap
+# Log live metrics, and check for early stopping, every N scored predictions
+EVALUATION_LOG_EVERY = 10
+# Stop once the confidence interval on macro-F0.5 is narrower than the target
+EARLY_STOPPING = False
+EARLY_STOPPING_INTERVAL = "bootstrap"  # "bootstrap" or "wilson"
+EARLY_STOPPING_TARGET_WIDTH = 0.1
+EARLY_STOPPING_CONFIDENCE = 0.95
+EARLY_STOPPING_MIN_SAMPLES = 30
+
+# CONFIGS: LONG DOCUMENTS
+# When enabled, lines longer than BATCH_SIZE_IN_TOKENS are split into
+# overlapping chunks that are checked concurrently instead of aborting the run
+LONG_DOCUMENT_MODE = False
+CHUNK_OVERLAP_IN_TOKENS = 200
+# How chunk verdicts are combined: "any_refutes", "majority" or
+# "confidence_weighted" (chunk requests then also ask for a confidence; for
+# coze, add the "confidence" field to the bot's prompt on the platform)
+CHUNK_REDUCTION = "any_refutes"
+
 
 # CONFIGS: PATHS
 FACT_CHECK_DATASET_FILENAME = "DataSet_Misinfo_first100"
@@ -80,6 +137,10 @@ CSV_OUTPUT_PATH = (
 REFERENCE_ANSWERS_PATH = (
     f"reference_output/{FACT_CHECK_DATASET_FILENAME}.correct"
 )
+RESULT_STORE_PATH = (
+    f"predicted_output/{FACT_CHECK_DATASET_FILENAME}.predicted.store"
+)
+CASSETTE_PATH = f"cassettes/{FACT_CHECK_DATASET_FILENAME}.cassette"
 
 
 # CONFIGS: API
@@ -93,6 +154,17 @@ COZE_API_KEY = os.getenv("COZE_API_KEY", "")
 MAX_RETRIES = 3  # Maximum number of retries for an API call
 RETRY_DELAY = 30  # Delay in seconds before retrying an API
 QPM_LIMIT = 10  # Queries per minute limit
+TPM_LIMIT = None  # Tokens per minute limit, None to disable
+# Batches read from the input and waiting on the rate limiter at once, which
+# bounds memory regardless of input size. Keep it at least QPM_LIMIT.
+MAX_BATCHES_IN_FLIGHT = 4 * QPM_LIMIT
+
+# "record" saves every provider request/response to CASSETTE_PATH, "replay"
+# serves them back without touching the network, None talks to the providers
+CASSETTE_MODE = None
+# Replay with the recorded latencies ("recorded") or as fast as possible
+# ("fast"). Fast replay also lifts the rate limits.
+CASSETTE_REPLAY_TIMING = "fast"
 
 
 # CONFIGS: OTHERS
@@ -106,6 +178,30 @@ RESET = "\033[0m"
 INCLUDE_INPUT_IN_CSV = True
 INCLUDE_ANSWER_IN_CSV = True
 
+# CONFIGS: SERVER (python3 main.py --serve)
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8080
+SERVER_BATCH_WINDOW_MS = 10  # How long a claim waits for others to share its batch
+# FACT_CHECK_PROMPT (and the default coze bot) answers one statement per
+# request; raise this only with a prompt that answers one line per input line
+SERVER_MAX_LINES_PER_BATCH = MAX_LINES_PER_BATCH
+SERVER_REQUEST_DEADLINE = 30  # Seconds a claim may wait before a 503
+# Claims the rate limit lets through within the deadline; beyond this, 503
+SERVER_MAX_QUEUE_SIZE = max(
+    1, QPM_LIMIT * SERVER_MAX_LINES_PER_BATCH * SERVER_REQUEST_DEADLINE // 60
+)
+SERVER_MAX_BATCHES_IN_FLIGHT = QPM_LIMIT
+SERVER_CACHE_SIZE = 10000
+# Clients are waiting, so fail fast rather than use MAX_RETRIES/RETRY_DELAY
+SERVER_MAX_RETRIES = 2
+SERVER_RETRY_DELAY = 0.5
+SERVER_REQUEST_TIMEOUT = 15  # Seconds per model request
+
+# Write results to the columnar result store instead of the CSV. Input text is
+# referenced by file offset, and the CSV becomes an optional export.
+USE_RESULT_STORE = False
+EXPORT_CSV_FROM_RESULT_STORE = False
+
 
 # for coze, please manually define the prompt on the platform
 FACT_CHECK_PROMPT = f"""You are a language model trained to evaluate the truthfulness of statements based on your knowledge, which is current up to {KNOWLEDGE_CUTOFF}. Your tasks are to:
@@ -128,6 +224,15 @@ Your output should be JSON only:
 
 Note: Your evaluations should only be based on factual information available up to {KNOWLEDGE_CUTOFF}."""
 
+# Used for chunk checks when CHUNK_REDUCTION is "confidence_weighted"
+CHUNK_CONFIDENCE_PROMPT = (
+    FACT_CHECK_PROMPT
+    + """
+
+Also report how confident you are in the prediction as a number between 0 and 1 in a "confidence" field, for example:
+{"prediction": "REFUTES", "confidence": 0.8}"""
+)
+
 
 # Generate a unique identifier for this run based on the current timestamp
 run_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -135,6 +240,8 @@ run_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 # Define log file paths with the unique run identifier
 LOGGING_OUTPUT_PATH = f"logs/run_{run_id}.log"
 ERROR_OUTPUT_PATH = f"logs/error_{run_id}.log"
+PROFILE_REPORT_PATH = f"logs/profile_{run_id}.txt"
+PROFILE_STACKS_PATH = f"logs/profile_{run_id}.collapsed"
 
 # Configure logging to output to a file
 logging.basicConfig(
@@ -158,39 +265,68 @@ root_logger = logging.getLogger()
 root_logger.addHandler(error_handler)
 
 
+# All clients share one cassette so a run records to (or replays from) one file
+cassette_transport = (
+    CassetteTransport(CASSETTE_PATH, CASSETTE_MODE, CASSETTE_REPLAY_TIMING)
+    if CASSETTE_MODE
+    else None
+)
+
+
+def is_fast_replay() -> bool:
+    return CASSETTE_MODE == "replay" and CASSETTE_REPLAY_TIMING == "fast"
+
+
+def get_http_client() -> Optional[httpx.AsyncClient]:
+    if cassette_transport is None:
+        return None  # Let the SDK create its own client
+    return httpx.AsyncClient(transport=cassette_transport)
+
+
 # Initialize the OpenAI client based on the selected model
 # TODO: return type
 def get_openai_client(model_name: str) -> Any:
     if model_name in GROQ_MODELS:
-        return groq.AsyncGroq(api_key=GROQ_API_KEY)
+        return groq.AsyncGroq(
+            api_key=GROQ_API_KEY, http_client=get_http_client()
+        )
     if model_name in LOCAL_LLM_MODELS:
         # Point to the local server
         return openai.AsyncOpenAI(
-            base_url=LOCAL_ENDPOINT, api_key="not-needed"
+            base_url=LOCAL_ENDPOINT,
+            api_key="not-needed",
+            http_client=get_http_client(),
         )
     if model_name in TOGETHER_AI_MODELS:
         # Point to the local server
         return openai.AsyncOpenAI(
-            base_url=TOGETHER_ENDPOINT, api_key=TOGETHER_API_KEY
+            base_url=TOGETHER_ENDPOINT,
+            api_key=TOGETHER_API_KEY,
+            http_client=get_http_client(),
         )
     if model_name in COZE_BOTS:
-        return AsyncCoze(api_key=COZE_API_KEY)
+        return AsyncCoze(api_key=COZE_API_KEY, transport=cassette_transport)
 
     # Initialize the OpenAI client with Azure endpoint and API key
     return openai.AsyncAzureOpenAI(
         azure_endpoint=AZURE_ENDPOINT,
         api_version="2023-12-01-preview",
         api_key=OPENAI_API_KEY,
+        http_client=get_http_client(),
     )
 
 
 client = get_openai_client(MODEL_NAME)
+model_clients = {
+    model_name: get_openai_client(model_name) for model_name in ENSEMBLE_MODELS
+}
 
 
 # Rate limiter using an asyncio Semaphore
 class RateLimiter:
-    def __init__(self, rate_limit: int):
+    def __init__(self, rate_limit: int, period: float = 60):
         self.rate_limit = rate_limit
+        self.period = period
         self.semaphore = asyncio.Semaphore(rate_limit)
 
     async def __aenter__(self):
@@ -198,21 +334,137 @@ class RateLimiter:
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
-        await asyncio.sleep(60 / self.rate_limit)
-        self.semaphore.release()
+        # The permit is held for the cooldown, but the caller is not
+        asyncio.get_running_loop().call_later(
+            self.period / self.rate_limit, self.semaphore.release
+        )
+
+
+# Token budget over a sliding one-minute window, so long inputs cost more
+# than short ones. Waiters are served in order, preserving dispatch priority.
+class TokenRateLimiter:
+    def __init__(self, tokens_per_minute: int, tokens_per_request: int = 0):
+        self.tokens_per_minute = tokens_per_minute
+        self.tokens_per_request = tokens_per_request
+        self.window = deque()  # (timestamp, tokens)
+        self.window_tokens = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int):
+        # A single request larger than the budget still gets through alone
+        tokens = min(tokens + self.tokens_per_request, self.tokens_per_minute)
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            while True:
+                now = loop.time()
+                while self.window and self.window[0][0] <= now - 60:
+                    self.window_tokens -= self.window.popleft()[1]
+                if self.window_tokens + tokens <= self.tokens_per_minute:
+                    self.window.append((now, tokens))
+                    self.window_tokens += tokens
+                    return
+                await asyncio.sleep(self.window[0][0] + 60 - now)
 
 
 rate_limiter = RateLimiter(QPM_LIMIT)
+token_rate_limiter: Optional[TokenRateLimiter] = None
+# Ensemble models are limited independently of MODEL_NAME and of each other
+model_rate_limiters = {}
+
+
+def create_rate_limiters() -> Tuple[RateLimiter, Optional[TokenRateLimiter]]:
+    if is_fast_replay():
+        # Nothing reaches the providers, so only concurrency is limited
+        return RateLimiter(QPM_LIMIT, period=0), None
+    return RateLimiter(QPM_LIMIT), (
+        TokenRateLimiter(TPM_LIMIT, count_tokens(FACT_CHECK_PROMPT))
+        if TPM_LIMIT
+        else None
+    )
+
+
+def init_rate_limiters():
+    global rate_limiter, token_rate_limiter, model_rate_limiters
+    rate_limiter, token_rate_limiter = create_rate_limiters()
+    model_rate_limiters = {
+        model_name: create_rate_limiters() for model_name in ENSEMBLE_MODELS
+    }
+
+
+def get_rate_limiters(
+    model_name: str,
+) -> Tuple[RateLimiter, Optional[TokenRateLimiter]]:
+    return model_rate_limiters.get(
+        model_name, (rate_limiter, token_rate_limiter)
+    )
+
+
+async def reserve_tokens(
+    text: str, token_limiter: Optional[TokenRateLimiter]
+):
+    if token_limiter is not None:
+        await token_limiter.acquire(count_tokens(text))
 
 
 async def main():
-    global rate_limiter
-    rate_limiter = RateLimiter(
-        QPM_LIMIT
-    )  # Initialize rate_limiter in the async context
+    init_rate_limiters()  # Initialize rate limiters in the async context
+    init_streaming_evaluation()
+    lag_monitor = (
+        asyncio.create_task(profiler.monitor_loop_lag())
+        if profiler.enabled
+        else None
+    )
     await process_file(
         client, TEST_FILE_PATH, CSV_OUTPUT_PATH, REFERENCE_ANSWERS_PATH
     )
+    if lag_monitor is not None:
+        lag_monitor.cancel()
+    if streaming_evaluator is not None:
+        logging.info(
+            f"{GREEN}Streaming evaluation: {streaming_evaluator.summary()}{RESET}"
+        )
+
+
+async def serve():
+    init_rate_limiters()  # Initialize rate limiters in the async context
+    lag_monitor = (
+        asyncio.create_task(profiler.monitor_loop_lag())
+        if profiler.enabled
+        else None
+    )
+    batcher = MicroBatcher(
+        check_claims,
+        count_tokens,
+        SERVER_BATCH_WINDOW_MS / 1000,
+        SERVER_MAX_LINES_PER_BATCH,
+        BATCH_SIZE_IN_TOKENS,
+        SERVER_MAX_QUEUE_SIZE,
+        SERVER_MAX_BATCHES_IN_FLIGHT,
+    )
+    server = FactCheckServer(
+        batcher, ClaimCache(SERVER_CACHE_SIZE), SERVER_REQUEST_DEADLINE
+    )
+    try:
+        await server.serve_forever(SERVER_HOST, SERVER_PORT)
+    finally:
+        if lag_monitor is not None:
+            lag_monitor.cancel()
+
+
+# Per-stage timers; no-ops unless started with --profile
+profiler = StageProfiler()
+
+
+def write_profile_report():
+    profiler.stop()
+    report = profiler.report()
+    with open(PROFILE_REPORT_PATH, "w", encoding="utf-8") as report_file:
+        report_file.write(report + "\n")
+    profiler.write_collapsed_stacks(PROFILE_STACKS_PATH)
+    logging.info(f"Profile report:\n{report}")
+    logging.info(
+        f"Profile written to {PROFILE_REPORT_PATH}, collapsed stacks to {PROFILE_STACKS_PATH}"
+    )
 
 
 def format_user_content(text: str) -> str:
@@ -221,9 +473,12 @@ def format_user_content(text: str) -> str:
     return json.dumps({"input": text_with_next_token})
 
 
+# Batching, scheduling and rate limiting all count the same texts
+@functools.lru_cache(maxsize=4096)
 def count_tokens(text: str) -> int:
     enc = get_encoding("gpt2")
-    tokens = enc.encode(text)
+    with profiler.stage("tokenization"):
+        tokens = enc.encode(text)
     token_count = len(tokens)
     return token_count
 
@@ -234,44 +489,250 @@ def calculate_avg_chars_per_token(sample_text: str) -> float:
     return total_chars / total_tokens
 
 
-def split_text_into_batches(
-    text: str,
+def batch_line_ranges(
+    lines: Iterable[str],
     batch_size_in_tokens: int = BATCH_SIZE_IN_TOKENS,
     max_lines: int = MAX_LINES_PER_BATCH,
-) -> List[str]:
-    lines = text.split("\n")
-    batches = []
-    current_batch = ""
+    long_document_mode: bool = LONG_DOCUMENT_MODE,
+) -> Tuple[List[Tuple[int, int]], List[int]]:
+    """Groups lines into batches in file order.
+
+    Returns the [start, end) line range and the token count of every batch.
+    Blank lines at the edges of a batch are left out of its range, so the
+    range holds exactly the lines of the stripped batch text.
+    """
+    ranges = []
+    token_counts = []
+    current_batch_start = 0
     current_batch_tokens = 0
     current_batch_lines = 0
+    # First and last lines of the current batch that are not blank
+    text_start = None
+    text_end = None
+
+    def close_batch():
+        if text_start is None:
+            # An all-blank batch is still sent, as a single empty line
+            ranges.append((current_batch_start, current_batch_start + 1))
+        else:
+            ranges.append((text_start, text_end))
+        token_counts.append(current_batch_tokens)
 
-    for line in lines:
+    for line_number, line in enumerate(lines):
         line_tokens = count_tokens(line + "\n")
         if line_tokens > batch_size_in_tokens:
-            print(
-                f"Error: Line exceeds the batch size of {batch_size_in_tokens} tokens."
-            )
-            print("Line:", line)
-            print("Tokens:", line_tokens)
-            sys.exit(1)
+            if not long_document_mode:
+                print(
+                    f"Error: Line exceeds the batch size of {batch_size_in_tokens} tokens."
+                )
+                print("Line:", line)
+                print("Tokens:", line_tokens)
+                sys.exit(1)
+
+            # Oversized lines get a batch of their own and are chunked when
+            # the batch is checked (see check_long_document)
+            if current_batch_lines:
+                close_batch()
+            ranges.append((line_number, line_number + 1))
+            token_counts.append(line_tokens)
+            current_batch_start = line_number + 1
+            current_batch_tokens = 0
+            current_batch_lines = 0
+            text_start = text_end = None
+            continue
 
         # If max_lines is None or the current batch size and lines are within limits
         if current_batch_tokens + line_tokens <= batch_size_in_tokens and (
             max_lines is None or current_batch_lines < max_lines
         ):
-            current_batch += line + "\n"
             current_batch_tokens += line_tokens
             current_batch_lines += 1
         else:
-            batches.append(current_batch.strip())
-            current_batch = line + "\n"
+            close_batch()
+            current_batch_start = line_number
             current_batch_tokens = line_tokens
             current_batch_lines = 1
+            text_start = text_end = None
+
+        if line.strip():
+            if text_start is None:
+                text_start = line_number
+            text_end = line_number + 1
+
+    if text_start is not None:
+        close_batch()
+
+    return ranges, token_counts
+
+
+class IndexedBatches(Sequence):
+    """Batches of an indexed file, kept as line ranges and read on access.
+
+    Reference answers are read through the same ranges over their own index,
+    so batch i of the answers always holds the labels of batch i's lines.
+    """
+
+    def __init__(
+        self,
+        line_index: LineIndex,
+        line_ranges: List[Tuple[int, int]],
+        token_counts: Optional[List[int]] = None,
+        strip: bool = True,
+    ):
+        self.line_index = line_index
+        self.line_ranges = line_ranges
+        self.token_counts = token_counts
+        self.strip = strip
+
+    def __len__(self) -> int:
+        return len(self.line_ranges)
+
+    def __getitem__(self, position: int) -> str:
+        start, end = self.line_ranges[position]
+        text = "\n".join(self.line_index.get_lines(start, end))
+        return text.strip() if self.strip else text
+
+    def spans(self, position: int) -> List[Tuple[int, int]]:
+        """Returns the (byte offset, byte length) of every line of a batch."""
+        start, end = self.line_ranges[position]
+        return [
+            self.line_index.line_span(line_number)
+            for line_number in range(start, min(end, len(self.line_index)))
+        ]
+
+
+def pack_lines_into_batches(
+    lines: Sequence[str],
+    line_tokens: List[int],
+    batch_size_in_tokens: int = BATCH_SIZE_IN_TOKENS,
+    max_lines: int = MAX_LINES_PER_BATCH,
+    long_document_mode: bool = LONG_DOCUMENT_MODE,
+) -> List[List[int]]:
+    """First-fit decreasing bin packing of lines under token and line limits.
+
+    Returns batches as lists of line indices, each in file order.
+    """
+    batches = []
+    open_batches = []  # (remaining tokens, batch index) of batches with room
+
+    for index in sorted(
+        range(len(lines)), key=lambda i: line_tokens[i], reverse=True
+    ):
+        tokens = line_tokens[index]
+        if tokens > batch_size_in_tokens:
+            if not long_document_mode:
+                print(
+                    f"Error: Line exceeds the batch size of {batch_size_in_tokens} tokens."
+                )
+                print("Line:", lines[index])
+                print("Tokens:", tokens)
+                sys.exit(1)
+            batches.append([index])
+            continue
+
+        for position, (remaining, batch_index) in enumerate(open_batches):
+            if tokens <= remaining:
+                batches[batch_index].append(index)
+                if max_lines is not None and len(batches[batch_index]) >= max_lines:
+                    open_batches.pop(position)
+                else:
+                    open_batches[position] = (remaining - tokens, batch_index)
+                break
+        else:
+            batches.append([index])
+            if max_lines is None or max_lines > 1:
+                open_batches.append(
+                    (batch_size_in_tokens - tokens, len(batches) - 1)
+                )
+
+    return [sorted(batch) for batch in batches]
+
+
+def sort_for_dispatch(
+    token_counts: List[int], dispatch_order: str = DISPATCH_ORDER
+) -> List[int]:
+    """Returns item indices in the order they should be dispatched."""
+    indices = list(range(len(token_counts)))
+    if dispatch_order == "file":
+        return indices
+    if dispatch_order == "shortest_first":
+        return sorted(indices, key=lambda i: token_counts[i])
+    if dispatch_order == "largest_first":
+        return sorted(indices, key=lambda i: token_counts[i], reverse=True)
+    if dispatch_order == "random":
+        random.Random(EVALUATION_SEED).shuffle(indices)
+        return indices
+    raise ValueError(f"Unknown dispatch order: {dispatch_order}")
+
+
+def dispatch_order() -> str:
+    # Streaming metrics are only representative of a random sample
+    return "random" if STREAMING_EVALUATION else DISPATCH_ORDER
+
+
+def split_line_into_chunks(
+    line: str,
+    chunk_size_in_tokens: int = BATCH_SIZE_IN_TOKENS,
+    overlap_in_tokens: int = CHUNK_OVERLAP_IN_TOKENS,
+) -> List[str]:
+    if overlap_in_tokens >= chunk_size_in_tokens:
+        raise ValueError(
+            "Chunk overlap must be smaller than the chunk size in tokens."
+        )
+
+    enc = get_encoding("gpt2")
+    tokens = enc.encode(line)
+    stride = chunk_size_in_tokens - overlap_in_tokens
+    chunks = []
+
+    for start in range(0, len(tokens), stride):
+        chunk = enc.decode(tokens[start : start + chunk_size_in_tokens])
+        chunks.append(chunk.strip())
+        # The last window already reaches the end of the line
+        if start + chunk_size_in_tokens >= len(tokens):
+            break
 
-    if current_batch.strip():
-        batches.append(current_batch.strip())
+    return chunks
 
-    return batches
+
+def vote_labels(labels: List[str]) -> str:
+    """Majority vote; ties go to the label seen first."""
+    return Counter(labels).most_common(1)[0][0]
+
+
+def reduce_chunk_verdicts(
+    verdicts: List[Tuple[str, Optional[float], int]],
+    reduction: str = CHUNK_REDUCTION,
+) -> str:
+    """Combines (label, confidence, token count) verdicts into one label.
+
+    Verdicts without a confidence weigh as fully confident.
+    """
+    labels = [label for label, _, _ in verdicts]
+
+    if reduction == "any_refutes":
+        if "REFUTES" in labels:
+            return "REFUTES"
+        return vote_labels(labels)
+    if reduction == "majority":
+        return vote_labels(labels)
+    if reduction == "confidence_weighted":
+        weights = Counter()
+        for label, confidence, token_count in verdicts:
+            weight = 1.0 if confidence is None else confidence
+            weights[label] += weight * token_count
+        return weights.most_common(1)[0][0]
+
+    raise ValueError(f"Unknown chunk reduction: {reduction}")
+
+
+def parse_confidence(value: Any) -> Optional[float]:
+    """Returns the model-reported confidence clamped to [0, 1], or None."""
+    try:
+        confidence = float(value)
+    except (TypeError, ValueError):
+        return None
+    return min(max(confidence, 0.0), 1.0)
 
 
 def escape_special_characters(s):
@@ -301,6 +762,18 @@ def extract_error_snippet(error: json.JSONDecodeError, window=20):
     return snippet
 
 
+class RetryPolicy(NamedTuple):
+    max_retries: int
+    retry_delay: float
+    request_timeout: Optional[float] = None  # Seconds per attempt
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy(MAX_RETRIES, RETRY_DELAY)
+SERVER_RETRY_POLICY = RetryPolicy(
+    SERVER_MAX_RETRIES, SERVER_RETRY_DELAY, SERVER_REQUEST_TIMEOUT
+)
+
+
 async def ask_llm(
     client: Any,
     prompt: str,
@@ -308,58 +781,91 @@ async def ask_llm(
     batch_number: int,
     total_batches: int,
     model_name: str,
+    exit_on_failure: bool = True,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
 ) -> str:
+    predicted_label, _ = await ask_llm_with_confidence(
+        client,
+        prompt,
+        text,
+        batch_number,
+        total_batches,
+        model_name,
+        exit_on_failure,
+        retry_policy,
+    )
+    return predicted_label
+
+
+async def ask_llm_with_confidence(
+    client: Any,
+    prompt: str,
+    text: str,
+    batch_number: int,
+    total_batches: int,
+    model_name: str,
+    exit_on_failure: bool = True,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+) -> Tuple[str, Optional[float]]:
+    max_retries, retry_delay, request_timeout = retry_policy
     retries = 0
-    while retries < MAX_RETRIES:
+    while retries < max_retries:
         try:
             logging.info(
                 f"Sending request for batch {batch_number}/{total_batches}: {text}"
             )
-            model_params = {
-                "model": model_name,
-                "messages": [
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": format_user_content(text)},
-                ],
-                "temperature": 0,
-                "max_tokens": MAX_TOKENS,
-            }
-            if model_name in OPENAI_JSON_MODE_SUPPORTED_MODELS:
-                model_params["response_format"] = {"type": "json_object"}
-            if model_name in COZE_BOTS:
-                # TODO: extract to .env
+            with profiler.stage("request_building"):
                 model_params = {
-                    "bot_id": model_name,
-                    "user": "KyleToh",
-                    "query": format_user_content(text),
-                    "stream": False,
+                    "model": model_name,
+                    "messages": [
+                        {"role": "system", "content": prompt},
+                        {"role": "user", "content": format_user_content(text)},
+                    ],
+                    "temperature": 0,
+                    "max_tokens": MAX_TOKENS,
                 }
+                if model_name in OPENAI_JSON_MODE_SUPPORTED_MODELS:
+                    model_params["response_format"] = {"type": "json_object"}
+                if model_name in COZE_BOTS:
+                    # TODO: extract to .env
+                    model_params = {
+                        "bot_id": model_name,
+                        "user": "KyleToh",
+                        "query": format_user_content(text),
+                        "stream": False,
+                    }
 
             # TODO: extract to a function
-            completion = await client.chat.completions.create(**model_params)
+            with profiler.stage("network"):
+                completion = await asyncio.wait_for(
+                    client.chat.completions.create(**model_params),
+                    request_timeout,
+                )
             response = completion.choices[0].message.content
 
             # TODO: debug special character
             logging.info(
                 f"{YELLOW}Received raw response for batch {batch_number}/{total_batches}: {response}{RESET}"
             )
-            content_json = json.loads(response)
-            response_text = content_json.get("prediction")
-            if response_text is None:
-                raise ValueError("'text' field not found in response JSON")
+            with profiler.stage("response_parsing"):
+                content_json = json.loads(response)
+                response_text = content_json.get("prediction")
+                if response_text is None:
+                    raise ValueError("'text' field not found in response JSON")
+                confidence = parse_confidence(content_json.get("confidence"))
 
-            # TODO: extract to a function
-            response_lines = []
-            for line in response_text.split(TEXT_DELIMITER):
-                response_lines.append(line.strip())
+                # TODO: extract to a function
+                response_lines = []
+                for line in response_text.split(TEXT_DELIMITER):
+                    response_lines.append(line.strip())
 
-            final_text = "\n".join(response_lines)
+                final_text = "\n".join(response_lines)
 
             assert len(response_lines) == len(
                 text.split("\n")
             ), "Number of lines in response_text does not match the number of lines in text."
 
-            return final_text
+            return final_text, confidence
         except json.JSONDecodeError as e:
             error_snippet = extract_error_snippet(e)
             logging.error(
@@ -369,16 +875,27 @@ async def ask_llm(
             logging.error(
                 f"Error processing response for batch {batch_number}/{total_batches}: {e}"
             )
+        except asyncio.TimeoutError:
+            logging.error(
+                f"Request for batch {batch_number}/{total_batches} timed out after {request_timeout}s"
+            )
         except Exception as e:
             logging.error(
                 f"An error occurred while processing batch {batch_number}/{total_batches}: {e}"
             )
         retries += 1
-        if retries < MAX_RETRIES:
+        if retries < max_retries:
             logging.info(
-                f"{YELLOW}Retrying for batch {batch_number}/{total_batches} (Attempt {retries}/{MAX_RETRIES}){RESET}"
+                f"{YELLOW}Retrying for batch {batch_number}/{total_batches} (Attempt {retries}/{max_retries}){RESET}"
+            )
+            await asyncio.sleep(retry_delay)
+        elif not exit_on_failure:
+            logging.error(
+                f"Max retries reached for batch {batch_number}/{total_batches}."
+            )
+            raise RuntimeError(
+                f"Max retries reached for batch {batch_number}/{total_batches}."
             )
-            await asyncio.sleep(RETRY_DELAY)
         else:
             logging.error(
                 f"Max retries reached for batch {batch_number}/{total_batches}. Exiting the program."
@@ -387,41 +904,361 @@ async def ask_llm(
     raise RuntimeError("Unexpected execution path")
 
 
-async def predict_label_and_write_csv(
+async def check_long_document(
     client: Any,
     text: str,
     batch_number: int,
     total_batches: int,
-    csv_writer: Any,
     model_name: str,
-    correct_answer: str,
+    exit_on_failure: bool = True,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
 ) -> str:
-    async with rate_limiter:
-        predicted_label = await ask_llm(
+    chunks = split_line_into_chunks(text)
+    logging.info(
+        f"Batch {batch_number}/{total_batches} exceeds {BATCH_SIZE_IN_TOKENS} tokens, checking it as {len(chunks)} chunks"
+    )
+
+    request_limiter, token_limiter = get_rate_limiters(model_name)
+
+    prompt = (
+        CHUNK_CONFIDENCE_PROMPT
+        if CHUNK_REDUCTION == "confidence_weighted"
+        else FACT_CHECK_PROMPT
+    )
+
+    async def check_chunk(chunk: str) -> Tuple[str, Optional[float], int]:
+        async with request_limiter:
+            await reserve_tokens(chunk, token_limiter)
+            label, confidence = await ask_llm_with_confidence(
+                client,
+                prompt,
+                chunk,
+                batch_number,
+                total_batches,
+                model_name,
+                exit_on_failure,
+                retry_policy,
+            )
+        return label, confidence, count_tokens(chunk)
+
+    verdicts = await asyncio.gather(*(check_chunk(chunk) for chunk in chunks))
+    logging.info(
+        f"Chunk verdicts for batch {batch_number}/{total_batches}: {verdicts}"
+    )
+    if CHUNK_REDUCTION == "confidence_weighted" and any(
+        confidence is None for _, confidence, _ in verdicts
+    ):
+        logging.warning(
+            f"{YELLOW}Some chunks of batch {batch_number}/{total_batches} came back without a confidence; they are weighted by token count alone{RESET}"
+        )
+    return reduce_chunk_verdicts(verdicts, CHUNK_REDUCTION)
+
+
+async def predict_label(
+    client: Any,
+    text: str,
+    batch_number: int,
+    total_batches: int,
+    model_name: str,
+    exit_on_failure: bool = True,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+) -> str:
+    if LONG_DOCUMENT_MODE and count_tokens(text) > BATCH_SIZE_IN_TOKENS:
+        # Each chunk acquires the rate limiter on its own
+        return await check_long_document(
+            client,
+            text,
+            batch_number,
+            total_batches,
+            model_name,
+            exit_on_failure,
+            retry_policy,
+        )
+
+    request_limiter, token_limiter = get_rate_limiters(model_name)
+    async with request_limiter:
+        await reserve_tokens(text, token_limiter)
+        return await ask_llm(
             client,
             FACT_CHECK_PROMPT,
             text,
             batch_number,
             total_batches,
             model_name,
+            exit_on_failure,
+            retry_policy,
+        )
+
+
+async def predict_batch(
+    client: Any,
+    text: str,
+    batch_number: int,
+    total_batches: int,
+    model_name: str,
+) -> Tuple[str, Optional[Dict[str, str]], float]:
+    """Returns the predicted labels, each ensemble model's labels and the latency."""
+    start_time = time.perf_counter()
+    model_labels = None
+    if ENSEMBLE_MODELS:
+        model_labels = await predict_ensemble(text, batch_number, total_batches)
+        predicted_label = (
+            vote_ensemble_labels(model_labels)
+            if ENSEMBLE_VOTE
+            else model_labels[ENSEMBLE_MODELS[0]]
+        )
+    else:
+        predicted_label = await predict_label(
+            client, text, batch_number, total_batches, model_name
         )
+    latency = time.perf_counter() - start_time
+
+    logging.info(
+        f"{GREEN}Received prediction for batch {batch_number}/{total_batches}: {predicted_label}{RESET}"
+    )
+    return predicted_label, model_labels, latency
+
 
+async def predict_label_and_write_csv(
+    client: Any,
+    text: str,
+    batch_number: int,
+    total_batches: int,
+    csv_writer: Any,
+    model_name: str,
+    correct_answer: str,
+    result_store: Optional[ResultStore] = None,
+    input_spans: Optional[List[Tuple[int, int]]] = None,
+) -> str:
+    predicted_label, model_labels, latency = await predict_batch(
+        client, text, batch_number, total_batches, model_name
+    )
+    await write_prediction(
+        csv_writer,
+        result_store,
+        batch_number,
+        text,
+        predicted_label,
+        correct_answer,
+        latency,
+        input_spans,
+        model_labels,
+    )
+    record_evaluation(predicted_label, correct_answer)
+    return predicted_label
+
+
+async def predict_ensemble(
+    text: str, batch_number: int, total_batches: int
+) -> Dict[str, str]:
+    labels = await asyncio.gather(
+        *(
+            predict_label(
+                model_clients[model_name],
+                text,
+                batch_number,
+                total_batches,
+                model_name,
+            )
+            for model_name in ENSEMBLE_MODELS
+        )
+    )
+    return dict(zip(ENSEMBLE_MODELS, labels))
+
+
+def vote_ensemble_labels(model_labels: Dict[str, str]) -> str:
+    """Votes line by line; ties go to the model listed first."""
+    model_lines = [labels.split("\n") for labels in model_labels.values()]
+    return "\n".join(
+        vote_labels(list(line_labels)) for line_labels in zip(*model_lines)
+    )
+
+
+streaming_evaluator: Optional[StreamingEvaluator] = None
+early_stop_event: Optional[asyncio.Event] = None
+last_evaluated_total = 0
+
+
+def init_streaming_evaluation():
+    global streaming_evaluator, early_stop_event
+    if not STREAMING_EVALUATION:
+        return
+    streaming_evaluator = StreamingEvaluator(
+        EVALUATION_CATEGORIES,
+        interval=EARLY_STOPPING_INTERVAL,
+        target_width=EARLY_STOPPING_TARGET_WIDTH,
+        confidence=EARLY_STOPPING_CONFIDENCE,
+        min_samples=EARLY_STOPPING_MIN_SAMPLES,
+        seed=EVALUATION_SEED,
+    )
+    early_stop_event = asyncio.Event()
+
+
+def record_evaluation(predicted_label: str, correct_answer: str):
+    global last_evaluated_total
+    if streaming_evaluator is None:
+        return
+
+    for predicted, correct in zip(
+        predicted_label.split("\n"), correct_answer.split("\n")
+    ):
+        # Lines without a reference answer cannot be scored
+        if correct.strip():
+            streaming_evaluator.update(correct.strip(), predicted.strip())
+
+    # The interval costs a bootstrap, so it is only recomputed every
+    # EVALUATION_LOG_EVERY scored lines
+    total = streaming_evaluator.total
+    if total == 0 or total - last_evaluated_total < EVALUATION_LOG_EVERY:
+        return
+    last_evaluated_total = total
+
+    interval = streaming_evaluator.confidence_interval()
+    summary = streaming_evaluator.summary(interval)
+    logging.info(f"{GREEN}Streaming evaluation: {summary}{RESET}")
+    if (
+        EARLY_STOPPING
+        and not early_stop_event.is_set()
+        and streaming_evaluator.should_stop(interval)
+    ):
         logging.info(
-            f"{GREEN}Received prediction for batch {batch_number}/{total_batches}: {predicted_label}{RESET}"
+            f"{GREEN}Confidence interval narrower than {EARLY_STOPPING_TARGET_WIDTH}, stopping early: {summary}{RESET}"
         )
+        early_stop_event.set()
+
+
+def stopped_early() -> bool:
+    return early_stop_event is not None and early_stop_event.is_set()
 
-        # Write the batch number and predicted text to the CSV
-        row = {
-            "Batch Number": batch_number,
-            "Predicted Label": predicted_label,
-        }
-        if INCLUDE_INPUT_IN_CSV:
-            row["Input Text"] = text
-        if INCLUDE_ANSWER_IN_CSV:
-            row["Correct Label"] = correct_answer
 
-        await csv_writer.writerow(row)
-        return predicted_label
+async def gather_until_early_stop(coroutines: List[Any]):
+    """Runs the batch tasks, cancelling those still pending on early stop."""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    if early_stop_event is None:
+        await asyncio.gather(*tasks)
+        return
+
+    stop_requested = asyncio.ensure_future(early_stop_event.wait())
+    pending = set(tasks)
+    try:
+        while pending and not stop_requested.done():
+            done, pending = await asyncio.wait(
+                pending | {stop_requested}, return_when=asyncio.FIRST_COMPLETED
+            )
+            pending.discard(stop_requested)
+            for task in done:
+                if task is not stop_requested:
+                    task.result()  # Re-raise any failure
+    finally:
+        stop_requested.cancel()
+
+    if pending:
+        logging.info(f"Early stop: skipping {len(pending)} remaining batches")
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+# aiofiles performs each write in a worker thread, so rows written
+# concurrently can interleave in the CSV unless writes are serialized
+csv_write_lock = asyncio.Lock()
+
+
+async def write_prediction(
+    csv_writer: Any,
+    result_store: Optional[ResultStore],
+    batch_number: int,
+    text: str,
+    predicted_label: str,
+    correct_answer: str,
+    latency: float,
+    input_spans: Optional[List[Tuple[int, int]]] = None,
+    model_labels: Optional[Dict[str, str]] = None,
+):
+    if result_store is not None:
+        with profiler.stage("result_store_writing"):
+            result_store.append(
+                batch_number,
+                predicted_label.split("\n"),
+                correct_answer.split("\n"),
+                latency,
+                count_tokens(text),
+                count_tokens(predicted_label),
+                input_spans or [],
+                {
+                    model: labels.split("\n")
+                    for model, labels in (model_labels or {}).items()
+                },
+            )
+        return
+
+    # Write the batch number and predicted text to the CSV
+    row = {
+        "Batch Number": batch_number,
+        "Predicted Label": predicted_label,
+    }
+    if INCLUDE_INPUT_IN_CSV:
+        row["Input Text"] = text
+    if INCLUDE_ANSWER_IN_CSV:
+        row["Correct Label"] = correct_answer
+    for model, labels in (model_labels or {}).items():
+        row[f"Predicted Label ({model})"] = labels
+
+    async with csv_write_lock:
+        with profiler.stage("csv_writing"):
+            await csv_writer.writerow(row)
+
+
+server_batch_count = 0
+
+
+def next_server_batch_number() -> int:
+    global server_batch_count
+    server_batch_count += 1
+    return server_batch_count
+
+
+async def check_claims(claims: List[str]) -> List[Any]:
+    """Checks micro-batched claims from the server as one packed request.
+
+    If a batch of several claims fails, each claim is retried on its own so
+    one bad response does not fail the others. Returns a label or the
+    exception raised for each claim.
+    """
+    if len(claims) > 1:
+        batch_number = next_server_batch_number()
+        try:
+            predicted_label = await predict_label(
+                client,
+                "\n".join(claims),
+                batch_number,
+                batch_number,
+                MODEL_NAME,
+                exit_on_failure=False,
+                retry_policy=SERVER_RETRY_POLICY._replace(max_retries=1),
+            )
+            return predicted_label.split("\n")
+        except Exception as e:
+            logging.warning(
+                f"{YELLOW}Server batch {batch_number} of {len(claims)} claims failed, checking them one by one: {e}{RESET}"
+            )
+
+    async def check_claim(claim: str) -> str:
+        batch_number = next_server_batch_number()
+        # Oversized claims always arrive alone, so check_long_document applies
+        return await predict_label(
+            client,
+            claim,
+            batch_number,
+            batch_number,
+            MODEL_NAME,
+            exit_on_failure=False,
+            retry_policy=SERVER_RETRY_POLICY,
+        )
+
+    return await asyncio.gather(
+        *(check_claim(claim) for claim in claims), return_exceptions=True
+    )
 
 
 # Function to check which batches have already been processed
@@ -444,6 +1281,12 @@ async def get_processed_batches(csv_output_path: str) -> set[int]:
     return processed_batches
 
 
+async def read_csv_header(csv_output_path: str) -> List[str]:
+    async with aiofiles.open(csv_output_path, "r", newline="") as csv_file:
+        header_line = await csv_file.readline()
+    return next(csv.reader([header_line]), [])
+
+
 async def process_file(
     client: Any,
     test_file_path: str,
@@ -451,7 +1294,11 @@ async def process_file(
     reference_answers_path: Optional[str] = None,
 ):
     # Check for existing output files
-    if os.path.exists(FINAL_OUTPUT_PATH) or os.path.exists(CSV_OUTPUT_PATH):
+    if (
+        os.path.exists(FINAL_OUTPUT_PATH)
+        or os.path.exists(CSV_OUTPUT_PATH)
+        or os.path.exists(RESULT_STORE_PATH)
+    ):
         user_input = (
             input(
                 "Existing output files found. Do you want to continue with existing files? Type 'reset' to delete and start fresh: "
@@ -465,68 +1312,294 @@ async def process_file(
                 os.remove(FINAL_OUTPUT_PATH)
             if os.path.exists(CSV_OUTPUT_PATH):
                 os.remove(CSV_OUTPUT_PATH)
+            if os.path.exists(RESULT_STORE_PATH):
+                shutil.rmtree(RESULT_STORE_PATH)
             print("Existing files removed. Starting fresh...")
         else:
             print("Continuing with existing files...")
 
+    with profiler.stage("input_reading"):
+        test_index = LineIndex(test_file_path)
+        answers_index = None
+        # Conditionally load answers if a valid reference_answers_path is provided and exists
+        if reference_answers_path and os.path.exists(reference_answers_path):
+            answers_index = LineIndex(reference_answers_path)
+
+    try:
+        await dispatch_file(client, test_index, answers_index, csv_output_path)
+    finally:
+        test_index.close()
+        if answers_index is not None:
+            answers_index.close()
+
+
+async def dispatch_file(
+    client: Any,
+    test_index: LineIndex,
+    answers_index: Optional[LineIndex],
+    csv_output_path: str,
+):
+    with profiler.stage("batching"):
+        line_ranges, token_counts = batch_line_ranges(
+            test_index.get_line(line_number)
+            for line_number in range(len(test_index))
+        )
+        batches = IndexedBatches(test_index, line_ranges, token_counts)
+    dispatch = dispatch_packed_lines if PACK_BATCHES else dispatch_batches
+
+    answers_batches = [None] * len(batches)
+    if answers_index is not None:
+        assert len(answers_index) == len(test_index), (
+            f"Mismatch between number of input lines ({len(test_index)}) "
+            f"and reference answer lines ({len(answers_index)})."
+        )
+        answers_batches = IndexedBatches(
+            answers_index, batches.line_ranges, strip=False
+        )
+
+    if USE_RESULT_STORE:
+        with ResultStore(RESULT_STORE_PATH, ENSEMBLE_MODELS) as result_store:
+            await dispatch(
+                client,
+                batches,
+                answers_batches,
+                result_store.processed_batches(),
+                None,
+                result_store,
+            )
+        return
+
     processed_batches = await get_processed_batches(csv_output_path)
     file_exists = os.path.exists(csv_output_path)
     should_write_header = (
         not file_exists or os.stat(csv_output_path).st_size == 0
     )
 
-    async with aiofiles.open(test_file_path, "r") as test_file:
-        text = await test_file.read()
-
-    batches = split_text_into_batches(text, BATCH_SIZE_IN_TOKENS)
-
-    answers_batches = [None] * len(batches)
-
-    # Conditionally load answers if a valid reference_answers_path is provided and exists
-    if reference_answers_path and os.path.exists(reference_answers_path):
-        async with aiofiles.open(reference_answers_path, "r") as answers_file:
-            text_answers = await answers_file.read()
-            # Assuming text_answers need to be split according to the number of batches
-            answers_batches = text_answers.split("\n", len(batches) - 1)
+    fieldnames = ["Batch Number"]
+    if INCLUDE_INPUT_IN_CSV:
+        fieldnames.append("Input Text")
+    if INCLUDE_ANSWER_IN_CSV:
+        fieldnames.append("Correct Label")
+    for model_name in ENSEMBLE_MODELS:
+        fieldnames.append(f"Predicted Label ({model_name})")
+    fieldnames.append("Predicted Label")
+
+    if not should_write_header:
+        # Rows appended under a different header would no longer line up
+        existing_fieldnames = await read_csv_header(csv_output_path)
+        if existing_fieldnames != fieldnames:
+            raise ValueError(
+                f"{csv_output_path} has columns {existing_fieldnames}, but this "
+                f"run writes {fieldnames}. Delete it or use another output path."
+            )
 
     async with aiofiles.open(csv_output_path, "a", newline="") as csv_file:
-        fieldnames = ["Batch Number"]
-        if INCLUDE_INPUT_IN_CSV:
-            fieldnames.append("Input Text")
-        if INCLUDE_ANSWER_IN_CSV:
-            fieldnames.append("Correct Label")
-        fieldnames.append("Predicted Label")
-
         csv_writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
         if should_write_header:
             await csv_file.write(
                 ",".join(f'"{name}"' for name in fieldnames) + "\n"
             )
 
-        assert len(batches) == len(
-            answers_batches
-        ), "Mismatch between number of input batches and answers batches."
+        await dispatch(
+            client, batches, answers_batches, processed_batches, csv_writer
+        )
 
-        total_batches = len(batches)
-        tasks = []
-        for batch_number, (batch_text, correct_answer) in enumerate(
-            zip(batches, answers_batches), start=1
-        ):
-            if batch_number in processed_batches:
-                continue
-            tasks.append(
-                predict_label_and_write_csv(
-                    client,
-                    batch_text,
-                    batch_number,
-                    total_batches,
-                    csv_writer,
-                    MODEL_NAME,
-                    correct_answer or "",
-                )
+
+async def dispatch_batches(
+    client: Any,
+    batches: IndexedBatches,
+    answers_batches: Sequence[Optional[str]],
+    processed_batches: set[int],
+    csv_writer: Any,
+    result_store: Optional[ResultStore] = None,
+):
+    total_batches = len(batches)
+    pending = [
+        batch_number
+        for batch_number in range(1, total_batches + 1)
+        if batch_number not in processed_batches
+    ]
+    token_counts = [batches.token_counts[n - 1] for n in pending]
+    batch_gate = asyncio.Semaphore(MAX_BATCHES_IN_FLIGHT)
+
+    # Batches are read from the index only once admitted by the gate
+    async def dispatch_batch(batch_number: int):
+        async with batch_gate:
+            await predict_label_and_write_csv(
+                client,
+                batches[batch_number - 1],
+                batch_number,
+                total_batches,
+                csv_writer,
+                MODEL_NAME,
+                answers_batches[batch_number - 1] or "",
+                result_store,
+                batches.spans(batch_number - 1) if result_store else None,
             )
 
-        await asyncio.gather(*tasks)
+    tasks = [
+        dispatch_batch(pending[position])
+        for position in sort_for_dispatch(token_counts, dispatch_order())
+    ]
+    await gather_until_early_stop(tasks)
+
+
+class PackedBatchRows:
+    """Writes the rows of batches whose lines were packed into other requests.
+
+    A packed request mixes lines from several batches, so each batch's row is
+    written, under its own batch number, once all of its lines are predicted.
+    """
+
+    def __init__(
+        self,
+        batches: IndexedBatches,
+        answers_batches: Sequence[Optional[str]],
+        positions: List[int],
+        csv_writer: Any,
+        result_store: Optional[ResultStore] = None,
+    ):
+        self.batches = batches
+        self.answers_batches = answers_batches
+        self.csv_writer = csv_writer
+        self.result_store = result_store
+        self.line_positions: Dict[int, int] = {}  # line number -> batch position
+        self.lines_left: Dict[int, int] = {}
+        self.latencies: Dict[int, float] = {}
+        self.line_labels: Dict[int, Tuple[str, Dict[str, str]]] = {}
+        for position in positions:
+            start, end = batches.line_ranges[position]
+            self.lines_left[position] = end - start
+            self.latencies[position] = 0.0
+            for line_number in range(start, end):
+                self.line_positions[line_number] = position
+
+    def line_numbers(self) -> List[int]:
+        return sorted(self.line_positions)
+
+    async def add(
+        self,
+        line_numbers: List[int],
+        predicted_labels: List[str],
+        model_labels: Optional[Dict[str, List[str]]],
+        latency: float,
+    ):
+        for index, line_number in enumerate(line_numbers):
+            self.line_labels[line_number] = (
+                predicted_labels[index],
+                {
+                    model: labels[index]
+                    for model, labels in (model_labels or {}).items()
+                },
+            )
+            position = self.line_positions[line_number]
+            # The row is ready when its slowest request is
+            self.latencies[position] = max(self.latencies[position], latency)
+            self.lines_left[position] -= 1
+            if self.lines_left[position] == 0:
+                await self._write_row(position)
+
+    async def _write_row(self, position: int):
+        start, end = self.batches.line_ranges[position]
+        labels = [
+            self.line_labels.pop(line_number) for line_number in range(start, end)
+        ]
+        predicted_label = "\n".join(label for label, _ in labels)
+        model_labels = None
+        if ENSEMBLE_MODELS:
+            model_labels = {
+                model: "\n".join(line_models[model] for _, line_models in labels)
+                for model in ENSEMBLE_MODELS
+            }
+        correct_answer = self.answers_batches[position] or ""
+
+        await write_prediction(
+            self.csv_writer,
+            self.result_store,
+            position + 1,
+            self.batches[position],
+            predicted_label,
+            correct_answer,
+            self.latencies[position],
+            self.batches.spans(position) if self.result_store else None,
+            model_labels,
+        )
+        record_evaluation(predicted_label, correct_answer)
+
+
+async def dispatch_packed_lines(
+    client: Any,
+    batches: IndexedBatches,
+    answers_batches: Sequence[Optional[str]],
+    processed_batches: set[int],
+    csv_writer: Any,
+    result_store: Optional[ResultStore] = None,
+):
+    pending = [
+        position
+        for position in range(len(batches))
+        if position + 1 not in processed_batches
+    ]
+    rows = PackedBatchRows(
+        batches, answers_batches, pending, csv_writer, result_store
+    )
+    line_numbers = rows.line_numbers()
+    # Every line is stripped and checked on its own line of a packed request
+    lines = IndexedBatches(
+        batches.line_index,
+        [(line_number, line_number + 1) for line_number in line_numbers],
+    )
+    with profiler.stage("batching"):
+        line_tokens = [
+            count_tokens(lines[index] + "\n") for index in range(len(lines))
+        ]
+        packed_batches = pack_lines_into_batches(lines, line_tokens)
+    batch_tokens = [
+        sum(line_tokens[index] for index in batch) for batch in packed_batches
+    ]
+    total_batches = len(packed_batches)
+    logging.info(
+        f"Packed {len(line_numbers)} lines of {len(pending)} batches into {total_batches} requests ({sum(batch_tokens)} tokens)"
+    )
+    batch_gate = asyncio.Semaphore(MAX_BATCHES_IN_FLIGHT)
+
+    async def dispatch_batch(position: int):
+        batch = packed_batches[position]
+        async with batch_gate:
+            predicted_label, model_labels, latency = await predict_batch(
+                client,
+                "\n".join(lines[index] for index in batch),
+                position + 1,
+                total_batches,
+                MODEL_NAME,
+            )
+            await rows.add(
+                [line_numbers[index] for index in batch],
+                predicted_label.split("\n"),
+                {
+                    model: labels.split("\n")
+                    for model, labels in (model_labels or {}).items()
+                },
+                latency,
+            )
+
+    tasks = [
+        dispatch_batch(position)
+        for position in sort_for_dispatch(batch_tokens, dispatch_order())
+    ]
+    await gather_until_early_stop(tasks)
+
+
+def generate_output_files_from_store(result_store_path: str, output_path: str):
+    with ResultStore(result_store_path, ENSEMBLE_MODELS) as result_store:
+        result_store.export_predictions(output_path)
+        if EXPORT_CSV_FROM_RESULT_STORE:
+            result_store.export_csv(
+                CSV_OUTPUT_PATH,
+                TEST_FILE_PATH,
+                INCLUDE_INPUT_IN_CSV,
+                INCLUDE_ANSWER_IN_CSV,
+            )
 
 
 def generate_prediction_file_from_csv(csv_output_path: str, output_path: str):
@@ -581,15 +1654,69 @@ def prompt_for_evaluation():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fact-check a dataset")
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="run as an HTTP service that checks single claims",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="report per-stage wall and CPU time and event loop lag, and sample stacks for flame graphs",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="like --profile, and also trace allocations per stage (slower, inflates the timings)",
+    )
+    args = parser.parse_args()
+    args.profile = args.profile or args.profile_memory
+    if args.profile:
+        profiler.start(trace_memory=args.profile_memory)
+
     logging.info("=" * 80)
-    logging.info(f"Model selected: {MODEL_NAME}")
+    if CASSETTE_MODE:
+        logging.info(
+            f"Cassette mode: {CASSETTE_MODE} ({CASSETTE_PATH}, timing: {CASSETTE_REPLAY_TIMING})"
+        )
+    if ENSEMBLE_MODELS:
+        logging.info(f"Ensemble models selected: {', '.join(ENSEMBLE_MODELS)}")
+    else:
+        logging.info(f"Model selected: {MODEL_NAME}")
     logging.info(
         f"{BLUE}Using prompt: {escape_special_characters(FACT_CHECK_PROMPT)}{RESET}"
     )
+    if args.serve:
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            logging.info("Server stopped.")
+        if args.profile:
+            write_profile_report()
+        sys.exit(0)
     logging.info("Starting to process the file...")
     asyncio.run(main())
-    logging.info("Generating the predicted file from CSV...")
-    generate_prediction_file_from_csv(CSV_OUTPUT_PATH, FINAL_OUTPUT_PATH)
+    with profiler.stage("final_file_generation"):
+        if USE_RESULT_STORE:
+            logging.info(
+                "Generating the predicted file from the result store..."
+            )
+            generate_output_files_from_store(
+                RESULT_STORE_PATH, FINAL_OUTPUT_PATH
+            )
+        else:
+            logging.info("Generating the predicted file from CSV...")
+            generate_prediction_file_from_csv(
+                CSV_OUTPUT_PATH, FINAL_OUTPUT_PATH
+            )
+    if args.profile:
+        write_profile_report()
     logging.info("File processing completed.")
-    prompt_for_evaluation()
+    if stopped_early():
+        logging.info(
+            "Run stopped early; skipping evaluation of the partial predictions."
+        )
+    else:
+        prompt_for_evaluation()
     logging.info("=" * 80)
@@ -0,0 +1,167 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+
+class StageStats:
+    def __init__(self):
+        self.calls = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.allocated = 0  # Net bytes still allocated when the stage exits (traced runs)
+
+
+class StageProfiler:
+    """Low-overhead per-stage timers, a stack sampler and an event loop lag probe.
+
+    Stages are timed with `with profiler.stage(name):` and cost nothing until
+    start() is called. Nested stages are also counted in their parents. CPU
+    time is that of the calling thread, so for stages that await, it also
+    covers whatever else the event loop ran meanwhile.
+
+    Allocation tracing (tracemalloc) hooks every allocation and inflates the
+    timings, so it is only enabled by start(trace_memory=True).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.stages: Dict[str, StageStats] = defaultdict(StageStats)
+        self.stacks = Counter()
+        self.loop_lags: List[float] = []
+        self.sample_interval = 0.005
+        self.started_at = 0.0
+        self.stopped_at = 0.0
+        self.sampler: Optional[threading.Thread] = None
+        self.sampling = threading.Event()
+        self.target_thread_id = threading.main_thread().ident
+        self.top_allocations = []
+
+    def start(self, sample_interval: float = 0.005, trace_memory: bool = False):
+        self.enabled = True
+        self.trace_memory = trace_memory
+        self.sample_interval = sample_interval
+        self.started_at = time.perf_counter()
+        if trace_memory:
+            tracemalloc.start()
+        self.sampling.set()
+        self.sampler = threading.Thread(
+            target=self._sample_stacks, name="stack-sampler", daemon=True
+        )
+        self.sampler.start()
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.stopped_at = time.perf_counter()
+        self.sampling.clear()
+        self.sampler.join()
+        if self.trace_memory:
+            self.top_allocations = tracemalloc.take_snapshot().statistics(
+                "lineno"
+            )[:15]
+            tracemalloc.stop()
+        self.enabled = False
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        memory_start = tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.thread_time() - cpu_start
+            stats = self.stages[name]
+            stats.calls += 1
+            stats.wall_time += wall_time
+            stats.cpu_time += cpu_time
+            if self.trace_memory:
+                stats.allocated += (
+                    tracemalloc.get_traced_memory()[0] - memory_start
+                )
+
+    def _sample_stacks(self):
+        while self.sampling.is_set():
+            frame = sys._current_frames().get(self.target_thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{os.path.basename(code.co_filename)}:{code.co_name}"
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.sample_interval)
+
+    async def monitor_loop_lag(self, interval: float = 0.05):
+        """Records how late the event loop wakes up from a sleep."""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.loop_lags.append(max(0.0, loop.time() - expected))
+
+    def report(self) -> str:
+        elapsed = (self.stopped_at or time.perf_counter()) - self.started_at
+        header = f"{'Stage':<24}{'Calls':>8}{'Wall (s)':>12}{'Mean (ms)':>12}{'CPU (s)':>10}"
+        if self.trace_memory:
+            header += f"{'Alloc (KiB)':>13}"
+        lines = [
+            f"Profile over {elapsed:.3f}s"
+            + ("" if self.trace_memory else " (allocation tracing off)"),
+            "",
+            header,
+        ]
+        for name, stats in sorted(
+            self.stages.items(), key=lambda item: item[1].wall_time, reverse=True
+        ):
+            mean = stats.wall_time / stats.calls * 1000 if stats.calls else 0
+            line = f"{name:<24}{stats.calls:>8}{stats.wall_time:>12.3f}{mean:>12.3f}{stats.cpu_time:>10.3f}"
+            if self.trace_memory:
+                line += f"{stats.allocated / 1024:>13.1f}"
+            lines.append(line)
+
+        if self.loop_lags:
+            lags = sorted(self.loop_lags)
+            p99 = lags[min(int(0.99 * len(lags)), len(lags) - 1)]
+            lines += [
+                "",
+                "Event loop lag (ms): "
+                f"mean {sum(lags) / len(lags) * 1000:.2f}, "
+                f"p99 {p99 * 1000:.2f}, max {lags[-1] * 1000:.2f} "
+                f"over {len(lags)} probes",
+            ]
+
+        total_samples = sum(self.stacks.values())
+        if total_samples:
+            leaf_counts = Counter()
+            for stack, count in self.stacks.items():
+                leaf_counts[stack.rsplit(";", 1)[-1]] += count
+            lines += ["", f"Top sampled functions ({total_samples} samples)"]
+            for function, count in leaf_counts.most_common(15):
+                lines.append(f"{count / total_samples:>7.1%}  {function}")
+
+        if self.top_allocations:
+            lines += ["", "Top allocations still held at the end of the run"]
+            for statistic in self.top_allocations:
+                lines.append(f"{statistic.size / 1024:>10.1f} KiB  {statistic.traceback}")
+
+        return "\n".join(lines)
+
+    def write_collapsed_stacks(self, path: str):
+        """Writes stacks in the collapsed format read by flamegraph.pl."""
+        with open(path, "w", encoding="utf-8") as collapsed_file:
+            for stack, count in self.stacks.most_common():
+                collapsed_file.write(f"{stack} {count}\n")
@@ -0,0 +1,344 @@
+import array
+import csv
+import json
+import mmap
+import os
+import re
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+# One file per column, each holding a packed native array of the given
+# typecode. A row is one predicted line; rows of the same batch share the
+# batch's latency and token counts. Ensemble runs add one label column per
+# model (see ResultStore.model_columns).
+COLUMNS = {
+    "batch_number": "I",
+    "line_in_batch": "I",
+    "predicted_label": "B",
+    "correct_label": "B",
+    "latency": "f",
+    "prompt_tokens": "I",
+    "completion_tokens": "I",
+    "input_offset": "Q",
+    "input_length": "I",
+}
+
+# Labels are stored as small integers; unseen labels are appended to the
+# vocabulary file. Code 0 is reserved for a missing label.
+DEFAULT_LABELS = ["", "SUPPORTS", "REFUTES", "NOT ENOUGH INFO"]
+LABELS_FILENAME = "labels.json"
+# The column set a store was created with; reopening with another one (e.g. a
+# different ENSEMBLE_MODELS) is rejected rather than misreading the rows
+COLUMNS_FILENAME = "columns.json"
+MAX_LABELS = 256
+
+
+def model_column_name(model_name: str) -> str:
+    return "predicted_label." + re.sub(r"[^A-Za-z0-9_.-]", "_", model_name)
+
+
+class ResultStore:
+    def __init__(self, path: str, model_names: List[str] = ()):
+        self.path = path
+        self.model_columns = {
+            model_name: model_column_name(model_name)
+            for model_name in model_names
+        }
+        self.columns = dict(COLUMNS)
+        for column_name in self.model_columns.values():
+            self.columns[column_name] = "B"
+        os.makedirs(path, exist_ok=True)
+        self._check_columns()
+        self.labels = self._load_labels()
+        self.label_codes = {label: code for code, label in enumerate(self.labels)}
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        for column_file in self.files.values():
+            column_file.close()
+        self.files = {}
+
+    def _column_path(self, name: str) -> str:
+        return os.path.join(self.path, f"{name}.{self.columns[name]}")
+
+    def _check_columns(self):
+        columns_path = os.path.join(self.path, COLUMNS_FILENAME)
+        if not os.path.exists(columns_path):
+            tmp_path = columns_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as columns_file:
+                json.dump(self.columns, columns_file)
+            os.replace(tmp_path, columns_path)
+            return
+        with open(columns_path, "r", encoding="utf-8") as columns_file:
+            stored_columns = json.load(columns_file)
+        if stored_columns != self.columns:
+            stored_models = sorted(
+                name for name in stored_columns if name not in COLUMNS
+            )
+            raise ValueError(
+                f"Result store {self.path} was created with model columns "
+                f"{stored_models}, not {sorted(self.model_columns.values())}. "
+                "Use the same ENSEMBLE_MODELS or a new RESULT_STORE_PATH."
+            )
+
+    def _load_labels(self) -> List[str]:
+        labels_path = os.path.join(self.path, LABELS_FILENAME)
+        if not os.path.exists(labels_path):
+            return list(DEFAULT_LABELS)
+        with open(labels_path, "r", encoding="utf-8") as labels_file:
+            return json.load(labels_file)
+
+    def _save_labels(self):
+        labels_path = os.path.join(self.path, LABELS_FILENAME)
+        tmp_path = labels_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as labels_file:
+            json.dump(self.labels, labels_file)
+        os.replace(tmp_path, labels_path)
+
+    def encode_label(self, label: str) -> int:
+        label = label.strip()
+        code = self.label_codes.get(label)
+        if code is None:
+            if len(self.labels) >= MAX_LABELS:
+                raise ValueError(
+                    f"Result store supports at most {MAX_LABELS} distinct labels."
+                )
+            code = len(self.labels)
+            self.labels.append(label)
+            self.label_codes[label] = code
+            self._save_labels()
+        return code
+
+    def append(
+        self,
+        batch_number: int,
+        predicted_labels: List[str],
+        correct_labels: List[str],
+        latency: float,
+        prompt_tokens: int,
+        completion_tokens: int,
+        input_spans: List[Tuple[int, int]],
+        model_labels: Optional[Dict[str, List[str]]] = None,
+    ):
+        row_count = len(predicted_labels)
+        # Pad or trim so every column gets exactly one value per row
+        correct_labels = (list(correct_labels) + [""] * row_count)[:row_count]
+        input_spans = (list(input_spans) + [(0, 0)] * row_count)[:row_count]
+
+        values = {
+            "batch_number": [batch_number] * row_count,
+            "line_in_batch": list(range(row_count)),
+            "predicted_label": [self.encode_label(l) for l in predicted_labels],
+            "correct_label": [self.encode_label(l) for l in correct_labels],
+            "latency": [latency] * row_count,
+            "prompt_tokens": [prompt_tokens] * row_count,
+            "completion_tokens": [completion_tokens] * row_count,
+            "input_offset": [offset for offset, _ in input_spans],
+            "input_length": [length for _, length in input_spans],
+        }
+        for model_name, column_name in self.model_columns.items():
+            labels = (model_labels or {}).get(model_name, [])
+            labels = (list(labels) + [""] * row_count)[:row_count]
+            values[column_name] = [self.encode_label(l) for l in labels]
+
+        if not self.files:
+            self._truncate_to_complete_rows()
+
+        # batch_number is written last, so a row only counts once all of
+        # its other columns are on disk
+        for name in list(self.columns)[1:] + ["batch_number"]:
+            column_file = self.files.get(name)
+            if column_file is None:
+                column_file = open(self._column_path(name), "ab")
+                self.files[name] = column_file
+            column_file.write(
+                array.array(self.columns[name], values[name]).tobytes()
+            )
+            column_file.flush()
+
+    def _column_rows(self, name: str) -> int:
+        column_path = self._column_path(name)
+        if not os.path.exists(column_path):
+            return 0
+        itemsize = array.array(self.columns[name]).itemsize
+        return os.path.getsize(column_path) // itemsize
+
+    def _truncate_to_complete_rows(self):
+        """Cuts every column back to the rows that were fully written.
+
+        A crash between column writes leaves values with no batch_number.
+        Appending after them would shift every later row, so they are
+        dropped before the store is written to again.
+        """
+        row_count = min(self._column_rows(name) for name in COLUMNS)
+        for name, typecode in self.columns.items():
+            column_path = self._column_path(name)
+            itemsize = array.array(typecode).itemsize
+            with open(column_path, "ab") as column_file:
+                # Model columns that were never written read as missing labels
+                column_file.write(
+                    bytes(max(0, row_count * itemsize - column_file.tell()))
+                )
+                column_file.truncate(row_count * itemsize)
+
+    @contextmanager
+    def mapped_columns(self) -> Iterator[Dict[str, memoryview]]:
+        """Memory-maps every column as a typed, zero-copy memoryview."""
+        maps = []
+        views = []
+        columns = {}
+        missing_model_columns = []
+        try:
+            for name, typecode in self.columns.items():
+                column_path = self._column_path(name)
+                if (
+                    not os.path.exists(column_path)
+                    or os.path.getsize(column_path) == 0
+                ):
+                    if name in COLUMNS:
+                        columns[name] = memoryview(array.array(typecode))
+                    else:
+                        missing_model_columns.append(name)
+                    continue
+                with open(column_path, "rb") as column_file:
+                    column_map = mmap.mmap(
+                        column_file.fileno(), 0, access=mmap.ACCESS_READ
+                    )
+                maps.append(column_map)
+                raw_view = memoryview(column_map)
+                itemsize = array.array(typecode).itemsize
+                usable = len(raw_view) - len(raw_view) % itemsize
+                views.append(raw_view)
+                views.append(raw_view[:usable])
+                columns[name] = views[-1].cast(typecode)
+                views.append(columns[name])
+
+            # A crash between column writes can leave some columns longer
+            row_count = min(len(column) for column in columns.values())
+            for name in columns:
+                columns[name] = columns[name][:row_count]
+                views.append(columns[name])
+            # Model columns never written to read as missing labels (code 0)
+            for name in missing_model_columns:
+                columns[name] = memoryview(
+                    array.array(self.columns[name], bytes(row_count))
+                )
+            yield columns
+        finally:
+            for view in reversed(views):
+                view.release()
+            for column_map in maps:
+                column_map.close()
+
+    def processed_batches(self) -> set[int]:
+        with self.mapped_columns() as columns:
+            return set(columns["batch_number"])
+
+    def _sorted_rows(self, columns: Dict[str, memoryview]) -> List[int]:
+        batch_numbers = columns["batch_number"]
+        lines_in_batch = columns["line_in_batch"]
+        return sorted(
+            range(len(batch_numbers)),
+            key=lambda row: (batch_numbers[row], lines_in_batch[row]),
+        )
+
+    def export_predictions(self, output_path: str):
+        """Writes the .predicted view: one label per line in batch order."""
+        with self.mapped_columns() as columns, open(
+            output_path, mode="w", newline="", encoding="utf-8"
+        ) as output_file:
+            predicted_labels = columns["predicted_label"]
+            for row in self._sorted_rows(columns):
+                output_file.write(self.labels[predicted_labels[row]] + "\n")
+
+    def export_csv(
+        self,
+        csv_output_path: str,
+        input_path: Optional[str] = None,
+        include_input: bool = True,
+        include_answer: bool = True,
+    ):
+        """Writes the same CSV main.py produces, one row per batch."""
+        fieldnames = ["Batch Number"]
+        if include_input and input_path:
+            fieldnames.append("Input Text")
+        if include_answer:
+            fieldnames.append("Correct Label")
+        for model_name in self.model_columns:
+            fieldnames.append(f"Predicted Label ({model_name})")
+        fieldnames.append("Predicted Label")
+
+        with self.mapped_columns() as columns, open(
+            csv_output_path, mode="w", newline="", encoding="utf-8"
+        ) as csv_file:
+            input_file = None
+            input_map = None
+            if "Input Text" in fieldnames and os.path.getsize(input_path) > 0:
+                input_file = open(input_path, "rb")
+                input_map = mmap.mmap(
+                    input_file.fileno(), 0, access=mmap.ACCESS_READ
+                )
+            try:
+                writer = csv.DictWriter(
+                    csv_file, fieldnames=fieldnames, quoting=csv.QUOTE_ALL
+                )
+                writer.writeheader()
+
+                rows = self._sorted_rows(columns)
+                start = 0
+                while start < len(rows):
+                    batch_number = columns["batch_number"][rows[start]]
+                    end = start
+                    while (
+                        end < len(rows)
+                        and columns["batch_number"][rows[end]] == batch_number
+                    ):
+                        end += 1
+                    batch_rows = rows[start:end]
+
+                    csv_row = {
+                        "Batch Number": batch_number,
+                        "Predicted Label": "\n".join(
+                            self.labels[columns["predicted_label"][row]]
+                            for row in batch_rows
+                        ),
+                    }
+                    if "Input Text" in fieldnames:
+                        csv_row["Input Text"] = "\n".join(
+                            self._read_input(input_map, columns, row)
+                            for row in batch_rows
+                        )
+                    for model_name, column_name in self.model_columns.items():
+                        csv_row[f"Predicted Label ({model_name})"] = "\n".join(
+                            self.labels[columns[column_name][row]]
+                            for row in batch_rows
+                        )
+                    if include_answer:
+                        csv_row["Correct Label"] = "\n".join(
+                            self.labels[columns["correct_label"][row]]
+                            for row in batch_rows
+                        )
+                    writer.writerow(csv_row)
+                    start = end
+            finally:
+                if input_map is not None:
+                    input_map.close()
+                if input_file is not None:
+                    input_file.close()
+
+    @staticmethod
+    def _read_input(
+        input_map: Optional[mmap.mmap], columns: Dict[str, memoryview], row: int
+    ) -> str:
+        if input_map is None:
+            return ""
+        offset = columns["input_offset"][row]
+        length = columns["input_length"][row]
+        return input_map[offset : offset + length].decode("utf-8", "replace")
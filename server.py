@@ -0,0 +1,370 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+
+MAX_REQUEST_BODY_BYTES = 1024 * 1024
+LATENCY_WINDOW = 10000  # Number of recent requests kept for percentiles
+
+STATUS_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+}
+
+
+class RequestError(Exception):
+    """A malformed request, answered with the given status before closing."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class ClaimCache:
+    """Least-recently-used cache of claim -> predicted label."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, claim: str) -> Optional[str]:
+        label = self.entries.get(claim)
+        if label is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(claim)
+        self.hits += 1
+        return label
+
+    def put(self, claim: str, label: str):
+        if self.max_size <= 0:
+            return
+        self.entries[claim] = label
+        self.entries.move_to_end(claim)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class MicroBatcher:
+    """Holds incoming claims for a short window and checks them together.
+
+    Claims are packed into one batch until the window closes or the line or
+    token budget is reached. At most max_batches_in_flight batches run at
+    once; when they are all busy the queue fills up and submit() raises
+    asyncio.QueueFull, which the server reports as 503. Claims whose caller
+    stopped waiting are dropped before they are batched.
+
+    check_batch returns one result per claim: its label, or the exception
+    that claim failed with.
+    """
+
+    def __init__(
+        self,
+        check_batch: Callable[
+            [List[str]], Awaitable[List[Union[str, BaseException]]]
+        ],
+        count_tokens: Callable[[str], int],
+        batch_window: float,
+        max_lines: int,
+        max_tokens: int,
+        max_queue_size: int,
+        max_batches_in_flight: int,
+    ):
+        self.check_batch = check_batch
+        self.count_tokens = count_tokens
+        self.batch_window = batch_window
+        self.max_lines = max_lines
+        self.max_tokens = max_tokens
+        self.queue: "asyncio.Queue[Tuple[str, int, asyncio.Future]]" = (
+            asyncio.Queue(max_queue_size)
+        )
+        self.in_flight = asyncio.Semaphore(max_batches_in_flight)
+        self.carry_over: Optional[Tuple[str, int, asyncio.Future]] = None
+        self.batch_tasks = set()
+        self.batches_sent = 0
+        self.claims_sent = 0
+
+    def submit(self, claim: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((claim, self.count_tokens(claim + "\n"), future))
+        return future
+
+    async def _next_item(
+        self, timeout: Optional[float] = None
+    ) -> Tuple[str, int, asyncio.Future]:
+        while True:
+            if self.carry_over is not None:
+                item, self.carry_over = self.carry_over, None
+            elif timeout is None:
+                item = await self.queue.get()
+            else:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            if not item[2].done():
+                return item
+
+    async def _collect_batch(self) -> List[Tuple[str, int, asyncio.Future]]:
+        batch = [await self._next_item()]
+        batch_tokens = batch[0][1]
+        deadline = time.perf_counter() + self.batch_window
+
+        while len(batch) < self.max_lines and batch_tokens < self.max_tokens:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = await self._next_item(remaining)
+            except asyncio.TimeoutError:
+                break
+            if batch_tokens + item[1] > self.max_tokens:
+                # Starts the next batch instead
+                self.carry_over = item
+                break
+            batch.append(item)
+            batch_tokens += item[1]
+
+        return batch
+
+    async def run(self):
+        while True:
+            await self.in_flight.acquire()
+            try:
+                batch = await self._collect_batch()
+            except BaseException:
+                self.in_flight.release()
+                raise
+            task = asyncio.create_task(self._check(batch))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
+
+    async def _check(self, batch: List[Tuple[str, int, asyncio.Future]]):
+        claims = [claim for claim, _, _ in batch]
+        futures = [future for _, _, future in batch]
+        try:
+            self.batches_sent += 1
+            self.claims_sent += len(claims)
+            labels = await self.check_batch(claims)
+            if len(labels) != len(claims):
+                raise RuntimeError(
+                    "Number of predictions does not match the number of claims."
+                )
+            for future, label in zip(futures, labels):
+                if future.done():
+                    continue
+                if isinstance(label, BaseException):
+                    future.set_exception(label)
+                else:
+                    future.set_result(label)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.in_flight.release()
+
+
+class FactCheckServer:
+    """Minimal asyncio HTTP/1.1 front end for the micro-batcher.
+
+    POST /check  {"claim": "..."} -> {"prediction": "...", "latency_ms": ...}
+    GET  /stats  throughput, cache and latency percentiles
+    GET  /health liveness probe
+
+    A claim not checked within request_deadline seconds is answered with 503.
+    """
+
+    def __init__(
+        self,
+        batcher: MicroBatcher,
+        cache: ClaimCache,
+        request_deadline: Optional[float] = None,
+    ):
+        self.batcher = batcher
+        self.cache = cache
+        self.request_deadline = request_deadline
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.requests_served = 0
+        self.requests_rejected = 0
+
+    async def serve_forever(self, host: str, port: int):
+        batcher_task = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logging.info(f"Fact-check server listening on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except RequestError as e:
+                    await self._write_response(
+                        writer, e.status, {"error": str(e)}, keep_alive=False
+                    )
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, payload = await self.route(method, path, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self._write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(
+        self, reader: asyncio.StreamReader
+    ) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        request_line = await self._read_line(reader, 400, "Request line too long")
+        if not request_line.strip():
+            return None
+        parts = request_line.decode("latin-1").split(" ", 2)
+        if len(parts) != 3:
+            raise RequestError(400, "Malformed request line")
+        method, path, _ = parts
+
+        headers = {}
+        while True:
+            line = await self._read_line(reader, 431, "Header line too long")
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            content_length = int(headers.get("content-length", "0"))
+        except ValueError:
+            raise RequestError(400, "Invalid Content-Length")
+        if content_length < 0:
+            raise RequestError(400, "Invalid Content-Length")
+        if content_length > MAX_REQUEST_BODY_BYTES:
+            raise RequestError(413, "Request body too large")
+        body = await reader.readexactly(content_length)
+        return method, path.split("?", 1)[0], headers, body
+
+    async def _read_line(
+        self, reader: asyncio.StreamReader, status: int, message: str
+    ) -> bytes:
+        try:
+            return await reader.readline()
+        except (ValueError, asyncio.LimitOverrunError):
+            # The line is longer than the stream reader's buffer limit
+            raise RequestError(status, message)
+
+    async def _write_response(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        payload: dict,
+        keep_alive: bool,
+    ):
+        body = json.dumps(payload).encode("utf-8")
+        head = [
+            f"HTTP/1.1 {status} {STATUS_REASONS[status]}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        if status == 503:
+            head.append("Retry-After: 1")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def route(self, method: str, path: str, body: bytes) -> Tuple[int, dict]:
+        if path == "/health":
+            return 200, {"status": "ok"}
+        if path == "/stats":
+            return 200, self.stats()
+        if path != "/check":
+            return 404, {"error": f"Unknown path: {path}"}
+        if method != "POST":
+            return 405, {"error": "Use POST for /check"}
+
+        try:
+            claim = json.loads(body).get("claim")
+        except (json.JSONDecodeError, UnicodeDecodeError, AttributeError):
+            return 400, {"error": "Body must be a JSON object"}
+        if not isinstance(claim, str) or not claim.strip():
+            return 400, {"error": "'claim' must be a non-empty string"}
+
+        return await self.check_claim(" ".join(claim.split()))
+
+    async def check_claim(self, claim: str) -> Tuple[int, dict]:
+        start_time = time.perf_counter()
+
+        prediction = self.cache.get(claim)
+        cached = prediction is not None
+        if not cached:
+            try:
+                future = self.batcher.submit(claim)
+            except asyncio.QueueFull:
+                self.requests_rejected += 1
+                return 503, {"error": "Server is busy, retry later"}
+            try:
+                prediction = await asyncio.wait_for(future, self.request_deadline)
+            except asyncio.TimeoutError:
+                self.requests_rejected += 1
+                logging.warning(
+                    f"Claim not checked within {self.request_deadline} s"
+                )
+                return 503, {"error": "Server is busy, retry later"}
+            except Exception as e:
+                logging.error(f"Failed to check claim: {e}")
+                return 502, {"error": str(e)}
+            self.cache.put(claim, prediction)
+
+        latency_ms = (time.perf_counter() - start_time) * 1000
+        self.latencies.append(latency_ms)
+        self.requests_served += 1
+        logging.info(
+            f"Checked claim in {latency_ms:.1f} ms (cached: {cached}): {prediction}"
+        )
+        return 200, {
+            "prediction": prediction,
+            "latency_ms": round(latency_ms, 3),
+            "cached": cached,
+        }
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p: float) -> Optional[float]:
+            if not latencies:
+                return None
+            index = min(int(p / 100 * len(latencies)), len(latencies) - 1)
+            return round(latencies[index], 3)
+
+        return {
+            "requests_served": self.requests_served,
+            "requests_rejected": self.requests_rejected,
+            "queue_depth": self.batcher.queue.qsize(),
+            "batches_sent": self.batcher.batches_sent,
+            "claims_sent": self.batcher.claims_sent,
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+            "latency_ms": {
+                "p50": percentile(50),
+                "p90": percentile(90),
+                "p99": percentile(99),
+                "max": round(latencies[-1], 3) if latencies else None,
+            },
+        }
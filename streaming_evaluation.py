@@ -0,0 +1,176 @@
+import math
+from collections import Counter
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+# Two-sided z-scores for the supported confidence levels
+Z_SCORES = {0.9: 1.6449, 0.95: 1.96, 0.99: 2.5758}
+
+
+def fbeta_from_counts(tp: int, fp: int, fn: int, beta: float) -> float:
+    """F-beta of one category; 0 when undefined (sklearn's zero_division=0)."""
+    beta_squared = beta * beta
+    denominator = (1 + beta_squared) * tp + beta_squared * fn + fp
+    if tp == 0 or denominator == 0:
+        return 0.0
+    return (1 + beta_squared) * tp / denominator
+
+
+def wilson_interval(successes: int, trials: int, z: float) -> Tuple[float, float]:
+    if trials == 0:
+        return 0.0, 1.0
+    p = successes / trials
+    denominator = 1 + z * z / trials
+    centre = (p + z * z / (2 * trials)) / denominator
+    margin = (
+        z
+        * math.sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials))
+        / denominator
+    )
+    return max(0.0, centre - margin), min(1.0, centre + margin)
+
+
+class StreamingEvaluator:
+    """Confusion counts and macro F-beta updated one prediction at a time.
+
+    Uses the same per-category one-vs-rest metrics as
+    commands/evaluate_model_performance.py, and can tell when the confidence
+    interval on macro F-beta is narrow enough to stop a run early:
+
+    - "bootstrap": percentile interval over resampled (true, predicted) pairs,
+      drawn as one multinomial over the confusion cells per resample
+    - "wilson": the widest Wilson interval among the per-category precisions
+      and recalls, a conservative stand-in since F-beta lies between them
+    """
+
+    def __init__(
+        self,
+        categories: List[str],
+        beta: float = 0.5,
+        interval: str = "bootstrap",
+        target_width: float = 0.1,
+        confidence: float = 0.95,
+        min_samples: int = 30,
+        bootstrap_samples: int = 500,
+        seed: Optional[int] = None,
+    ):
+        if interval not in ("bootstrap", "wilson"):
+            raise ValueError(f"Unknown confidence interval: {interval}")
+        if confidence not in Z_SCORES:
+            raise ValueError(
+                f"Confidence must be one of {sorted(Z_SCORES)}, got {confidence}"
+            )
+
+        self.categories = categories
+        self.beta = beta
+        self.interval = interval
+        self.target_width = target_width
+        self.confidence = confidence
+        self.min_samples = min_samples
+        self.bootstrap_samples = bootstrap_samples
+        self.rng = np.random.default_rng(seed)
+        # Counts of (true label, predicted label) pairs; the whole confusion
+        # matrix, and all a bootstrap resample needs
+        self.pair_counts = Counter()
+        self.total = 0
+
+    def update(self, true_label: str, predicted_label: str):
+        self.pair_counts[(true_label, predicted_label)] += 1
+        self.total += 1
+
+    def _category_counts(self, pair_counts: Counter) -> List[Tuple[int, int, int]]:
+        counts = []
+        for category in self.categories:
+            tp = fp = fn = 0
+            for (true_label, predicted_label), count in pair_counts.items():
+                if true_label == category and predicted_label == category:
+                    tp += count
+                elif predicted_label == category:
+                    fp += count
+                elif true_label == category:
+                    fn += count
+            counts.append((tp, fp, fn))
+        return counts
+
+    def _macro_fscore(self, pair_counts: Counter) -> float:
+        fscores = [
+            fbeta_from_counts(tp, fp, fn, self.beta)
+            for tp, fp, fn in self._category_counts(pair_counts)
+        ]
+        return sum(fscores) / len(fscores)
+
+    def macro_fscore(self) -> float:
+        return self._macro_fscore(self.pair_counts)
+
+    def accuracy(self) -> float:
+        if self.total == 0:
+            return 0.0
+        correct = sum(
+            count
+            for (true_label, predicted_label), count in self.pair_counts.items()
+            if true_label == predicted_label
+        )
+        return correct / self.total
+
+    def confidence_interval(self) -> Tuple[float, float]:
+        if self.total == 0:
+            return 0.0, 1.0
+        if self.interval == "wilson":
+            return self._wilson_interval()
+        return self._bootstrap_interval()
+
+    def _bootstrap_interval(self) -> Tuple[float, float]:
+        pairs = list(self.pair_counts)
+        counts = np.array([self.pair_counts[pair] for pair in pairs])
+        # One row per resample, one column per (true, predicted) cell
+        resamples = self.rng.multinomial(
+            self.total, counts / self.total, size=self.bootstrap_samples
+        )
+        beta_squared = self.beta * self.beta
+        fscores = np.zeros(self.bootstrap_samples)
+        for category in self.categories:
+            true_hits = np.array([t == category for t, _ in pairs])
+            predicted_hits = np.array([p == category for _, p in pairs])
+            tp = resamples[:, true_hits & predicted_hits].sum(axis=1)
+            fp = resamples[:, ~true_hits & predicted_hits].sum(axis=1)
+            fn = resamples[:, true_hits & ~predicted_hits].sum(axis=1)
+            denominator = (1 + beta_squared) * tp + beta_squared * fn + fp
+            fscores += np.where(
+                tp > 0,
+                (1 + beta_squared) * tp / np.maximum(denominator, 1),
+                0.0,
+            )
+        fscores = np.sort(fscores / len(self.categories))
+        tail = (1 - self.confidence) / 2
+        low = fscores[int(tail * (len(fscores) - 1))]
+        high = fscores[int(math.ceil((1 - tail) * (len(fscores) - 1)))]
+        return float(low), float(high)
+
+    def _wilson_interval(self) -> Tuple[float, float]:
+        z = Z_SCORES[self.confidence]
+        width = 0.0
+        for tp, fp, fn in self._category_counts(self.pair_counts):
+            for trials in (tp + fp, tp + fn):
+                if trials == 0:
+                    # Not observed yet; contributes a constant 0 to F-beta
+                    continue
+                low, high = wilson_interval(tp, trials, z)
+                width = max(width, high - low)
+        fscore = self.macro_fscore()
+        return max(0.0, fscore - width / 2), min(1.0, fscore + width / 2)
+
+    def should_stop(self, interval: Optional[Tuple[float, float]] = None) -> bool:
+        if self.total < self.min_samples:
+            return False
+        low, high = interval or self.confidence_interval()
+        return high - low <= self.target_width
+
+    def summary(self, interval: Optional[Tuple[float, float]] = None) -> str:
+        low, high = interval or self.confidence_interval()
+        return (
+            f"n={self.total} macro-F{self.beta}={self.macro_fscore():.4f} "
+            f"[{low:.4f}, {high:.4f}] @ {self.confidence:.0%}, "
+            f"accuracy={self.accuracy():.4f}"
+        )
@@ -0,0 +1,33 @@
+import array
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from result_store import COLUMNS, ResultStore
+
+
+def test_resume_after_partial_row_drops_stale_values(tmp_path):
+    store_path = str(tmp_path / "store")
+    with ResultStore(store_path) as store:
+        store.append(1, ["SUPPORTS"], ["REFUTES"], 0.5, 10, 2, [(0, 5)])
+
+    # A crash after every column but batch_number was written
+    for name, typecode in COLUMNS.items():
+        if name == "batch_number":
+            continue
+        with open(os.path.join(store_path, f"{name}.{typecode}"), "ab") as f:
+            f.write(array.array(typecode, [7]).tobytes())
+
+    with ResultStore(store_path) as store:
+        assert store.processed_batches() == {1}
+        store.append(2, ["REFUTES"], ["SUPPORTS"], 0.25, 20, 4, [(6, 8)])
+        with store.mapped_columns() as columns:
+            assert list(columns["batch_number"]) == [1, 2]
+            assert [store.labels[i] for i in columns["predicted_label"]] == [
+                "SUPPORTS",
+                "REFUTES",
+            ]
+            assert list(columns["latency"]) == [0.5, 0.25]
+            assert list(columns["input_offset"]) == [0, 6]
+            assert list(columns["input_length"]) == [5, 8]